@@ -1,48 +1,437 @@
+import asyncio
+import codecs
 import json
+import mmap
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import docker
 import yara
 import os
+import re
+import secrets
+import shlex
 import hashlib
+import shelve
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, List, Optional
 import logging
 
+try:
+    import httpx
+    import h2  # noqa: F401  (required by httpx for HTTP/2)
+except ImportError:
+    httpx = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+# Benchmark-mode instances log here instead; its level drops every record
+# before one is built, without touching the logger other instances share
+silent_logger = logging.getLogger(__name__ + ".benchmark")
+silent_logger.setLevel(logging.CRITICAL + 1)
+silent_logger.propagate = False
+
+# (connect, read) timeout in seconds for registry requests
+HTTP_TIMEOUT = (3, 10)
+# Read size when streaming responses into a hasher
+HASH_CHUNK_SIZE = 64 * 1024
+# Leading bytes of a gzip stream, used to spot .tar.gz sdists
+GZIP_MAGIC = b"\x1f\x8b"
+# Per-call YARA timeout in seconds
+YARA_TIMEOUT = 30
+# Where pip keeps its wheel cache inside the sandbox container
+SANDBOX_PIP_CACHE = "/root/.cache/pip"
+# Shell run inside the sandbox for each exec. Packages go into a throwaway
+# venv so one package's .pth or sitecustomize can't leak into later runs.
+SANDBOX_COMMAND = """
+env=$(mktemp -d) || exit 1
+trap 'rm -rf "$env"' EXIT
+trap 'exit 143' TERM
+python -m venv "$env" && "$env/bin/pip" install --cache-dir {cache} {install_args} && "$env/bin/python" -c {script}
+"""
+# Exit codes from `timeout` when the command ran out of time (TERM, then KILL)
+SANDBOX_TIMEOUT_CODES = {124, 137}
+# Printed before each package's import test in a batched sandbox run,
+# followed by a per-batch nonce so packages can't easily forge it
+SANDBOX_IMPORT_MARKER = "@@scsentry-import"
+# Import test run inside the sandbox for a batch of packages
+SANDBOX_IMPORT_SCRIPT = """
+for i, p in enumerate({packages!r}):
+    print({marker!r}, i, flush=True)
+    try:
+        __import__(p)
+    except Exception as e:
+        print(p, e, flush=True)
+"""
+
+# Rule headers and string definitions in a YARA source file, used to build
+# the optional Hyperscan prefilter
+_YARA_RULE_RE = re.compile(r'^\s*(?:(?:private|global)\s+)*rule\s+\w+', re.M)
+_YARA_STRINGS_RE = re.compile(r'\bstrings\s*:')
+_YARA_CONDITION_RE = re.compile(r'\bcondition\s*:(?P<condition>.*)\}', re.S)
+# Any string definition, used to check each one was translated
+_YARA_ANY_STRING_DEF_RE = re.compile(r'\$\w*\s*=(?!=)')
+_YARA_COMMENT_RE = re.compile(r'//[^\n]*|/\*.*?\*/', re.S)
+# Condition terms that only hold when at least one string matched: a string
+# reference, or "any/all/N of them|($a, $b*)" with N >= 1
+_YARA_STRING_TERM_RE = re.compile(
+    r'\$\w*\*?(?![\w\[])'
+    r'|\b(?:any|all|[1-9]\d*)\s+of\s+(?:them\b|\(\s*\$\w*\*?(?:\s*,\s*\$\w*\*?)*\s*\))'
+)
+_YARA_STRING_DEF_RE = re.compile(
+    r'^\s*\$\w*\s*=\s*'
+    r'(?:"(?P<text>(?:[^"\\\n]|\\.)*)"|/(?P<regex>(?:[^/\\\n]|\\.)+)/(?P<flags>[is]*)|(?P<hex>\{))'
+    r'(?P<modifiers>[^\n]*)$',
+    re.M
+)
+# A backslash line continuation, folded away before parsing so hash-pinned
+# requirements (pip-compile --generate-hashes) sit on one logical line
+_CONTINUATION_RE = re.compile(r'\\[ \t]*\r?\n')
+# A pinned "package[extras]==version --option ; marker" requirement, where
+# options are per-requirement flags such as --hash=sha256:..., optionally
+# followed by a comment. Stray --hash lines are matched and ignored; any
+# other non-blank, non-comment line is captured as "other" so it can be
+# reported rather than silently dropped.
+_REQUIREMENT_RE = re.compile(
+    r'^[ \t]*(?:'
+    r'(?P<name>[A-Za-z0-9_.\-]+)(?:[ \t]*\[[^\]\r\n]*\])?'
+    r'[ \t]*==[ \t]*(?P<version>[A-Za-z0-9_.\-+!]+)'
+    r'(?:[ \t]+--[A-Za-z][A-Za-z0-9\-]*(?:=[^\s#]+)?)*'
+    r'[ \t]*(?:;[^#\r\n]*)?(?:#[^\r\n]*)?'
+    r'|--hash[^\r\n]*'
+    r'|(?P<other>[^\s#][^\r\n]*?))[ \t]*\r?$',
+    re.M
+)
+
+# Log phrases that hint at sandboxed behavior, mapped to the baseline field
+# that would make them expected
+ANOMALY_TRIGGERS = {
+    "network error": "network_calls",
+    "permission denied": "file_access",
+}
+# One capture group per trigger, so a match reports its baseline field via
+# lastindex without re-normalizing the matched text
+_ANOMALY_FIELDS = list(ANOMALY_TRIGGERS.values())
+_ANOMALY_RE = re.compile(
+    "|".join(f"({re.escape(phrase)})" for phrase in ANOMALY_TRIGGERS),
+    re.IGNORECASE
+)
+
+# Risk signals: name -> (weight, finding threshold, finding). Each signal is
+# a value in [0, 1] (or a raw score for the maintainer), weighted into the
+# package risk score and reported once it exceeds its threshold.
+RISK_SIGNALS = {
+    "static": (0.4, 0.0, "Potential backdoors detected in static analysis"),
+    "dynamic": (0.3, 0.0, "Anomalous behavior detected in dynamic analysis"),
+    "maintainer": (1.0, 0.2, "Suspicious maintainer activity"),
+}
+
+# String modifiers the prefilter can honour (fullword only narrows matches)
+_PREFILTER_MODIFIERS = {"ascii", "nocase", "fullword", "private"}
+
+def loads_json(data: bytes):
+    """Parse JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 class SupplyChainSentry:
+    log = logger
+
     def __init__(self, config_path: str = "config.json"):
         self.config = self.load_config(config_path)
+        # Keep logging out of timing runs entirely, for this instance only
+        if self.config.get("benchmark", False):
+            self.log = silent_logger
         self.baselines: Dict[str, Dict] = {}
+        self._baselines_lock = threading.Lock()
+        self.http = self.create_http_session()
+        self._cache_lock = threading.Lock()
+        self._cache_memo: Dict[str, Dict] = {}
+        self.cache = self.open_cache()
+        self.hash_algorithm = self.resolve_hash_algorithm()
         self.docker_client = docker.from_env()
+        self._sandbox_slots = threading.Semaphore(self.config.get("sandbox_concurrency", 1))
+        self.sandbox = self.start_sandbox()
         self.yara_rules = self.load_yara_rules()
+        self._prefilter_lock = threading.Lock()
+        self.prefilter = self.build_prefilter()
         self.risk_threshold = self.config.get("risk_threshold", 0.7)
 
     def load_config(self, config_path: str) -> Dict:
         """Load configuration from JSON file."""
         try:
-            with open(config_path, 'r') as f:
-                return json.load(f)
+            with open(config_path, 'rb') as f:
+                return loads_json(f.read())
         except FileNotFoundError:
-            logger.warning("Config file not found, using defaults")
+            self.log.warning("Config file not found, using defaults")
             return {
                 "packages": [],
                 "yara_rules_path": "rules.yara",
                 "risk_threshold": 0.7,
-                "registry_url": "https://pypi.org/pypi"
+                "registry_url": "https://pypi.org/pypi",
+                "concurrency": 16,
+                "cache_dir": "~/.cache/scsentry",
+                "maintainer_cache_ttl": 86400,
+                "release_cache_ttl": 86400,
+                "http2_prefetch": True,
+                "hash_algorithm": "sha256",
+                "max_scan_bytes": 32 * 1024 * 1024,
+                "hyperscan_prefilter": False,
+                "sandbox_image": "python:3.9-slim",
+                "sandbox_pip_cache_volume": "scsentry-pip-cache",
+                "sandbox_concurrency": 1,
+                "sandbox_batch_size": 20,
+                "sandbox_timeout": 300,
+                "stage_order": ["maintainer", "static", "dynamic"],
+                # With the default weights, maintainer + static tops out at 0.6,
+                # so fast_fail only skips dynamic analysis once
+                # risk_threshold + fast_fail_margin is at or below that
+                "fast_fail": False,
+                "fast_fail_margin": 0.0,
+                "benchmark": False
             }
 
+    def create_http_session(self) -> requests.Session:
+        """Create a pooled HTTP session so registry lookups reuse connections."""
+        session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+        session.mount("https://", adapter)
+        return session
+
+    def open_cache(self) -> Optional[shelve.Shelf]:
+        """Open the persistent cache of registry responses."""
+        cache_dir = os.path.expanduser(self.config.get("cache_dir", "~/.cache/scsentry"))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            return shelve.open(os.path.join(cache_dir, "registry"))
+        except Exception as e:
+            self.log.warning("Registry cache unavailable, continuing without it: %s", e)
+            return None
+
+    def cache_get(self, url: str) -> Optional[Dict]:
+        """Look up a cached registry entry for a URL."""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        with self._cache_lock:
+            entry = self._cache_memo.get(key)
+            if entry is None and self.cache is not None:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self._cache_memo[key] = entry
+            return entry
+
+    def cache_set(self, url: str, entry: Dict) -> None:
+        """Store a registry entry for a URL in memory and on disk."""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        with self._cache_lock:
+            self._cache_memo[key] = entry
+            if self.cache is not None:
+                self.cache[key] = entry
+                self.cache.sync()
+
+    def start_sandbox(self):
+        """Start the long-lived container used for dynamic analysis."""
+        image = self.config.get("sandbox_image", "python:3.9-slim")
+        volume = self.config.get("sandbox_pip_cache_volume", "scsentry-pip-cache")
+        # Only pull when the image isn't available locally, so an offline
+        # host or a registry rate limit doesn't disable dynamic analysis
+        try:
+            self.docker_client.images.get(image)
+        except docker.errors.ImageNotFound:
+            try:
+                self.docker_client.images.pull(image)
+            except Exception as e:
+                self.log.error("Failed to pull sandbox image %s: %s", image, e)
+        except Exception as e:
+            self.log.warning("Could not inspect sandbox image %s: %s", image, e)
+        try:
+            return self.docker_client.containers.run(
+                image,
+                "sleep infinity",
+                detach=True,
+                remove=True,
+                volumes={volume: {"bind": SANDBOX_PIP_CACHE, "mode": "rw"}}
+            )
+        except Exception as e:
+            self.log.error("Failed to start sandbox container: %s", e)
+            return None
+
+    def close(self) -> None:
+        """Stop the sandbox, release the HTTP session and flush the registry cache."""
+        if self.sandbox is not None:
+            try:
+                self.sandbox.stop(timeout=5)
+            except Exception as e:
+                self.log.warning("Failed to stop sandbox container: %s", e)
+            self.sandbox = None
+        self.http.close()
+        with self._cache_lock:
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+
+    def resolve_hash_algorithm(self) -> str:
+        """Pick the digest used for package hashes, falling back to sha256."""
+        # sha256 goes through OpenSSL, which uses SHA-NI where the CPU has it;
+        # blake2b is faster in software on machines without it.
+        algorithm = self.config.get("hash_algorithm", "sha256")
+        if algorithm not in hashlib.algorithms_available:
+            self.log.warning("Hash algorithm %s unavailable, using sha256", algorithm)
+            return "sha256"
+        if hashlib.new(algorithm).digest_size == 0:
+            # Variable-length digests (shake_128/256) need a length for hexdigest()
+            self.log.warning("Hash algorithm %s has no fixed digest size, using sha256", algorithm)
+            return "sha256"
+        return algorithm
+
+    def new_hasher(self):
+        """Create a hash object for the configured algorithm."""
+        if self.hash_algorithm == "blake2b":
+            # Match sha256's digest length so stored hashes keep the same shape
+            return hashlib.blake2b(digest_size=32)
+        return hashlib.new(self.hash_algorithm)
+
     def load_yara_rules(self) -> Optional[yara.Rules]:
         """Load YARA rules for static analysis."""
         try:
-            return yara.compile(self.config.get("yara_rules_path", "rules.yara"))
+            return self._compile_or_load_rules(self.config.get("yara_rules_path", "rules.yara"))
         except Exception as e:
-            logger.error(f"Failed to load YARA rules: {e}")
+            self.log.error("Failed to load YARA rules: %s", e)
             return None
 
-    def create_behavioral_baseline(self, package: str, version: str) -> Dict:
+    def _compile_or_load_rules(self, source_path: str) -> yara.Rules:
+        # Reuse the precompiled rules when they are newer than the source
+        compiled_path = self.config.get("yara_compiled_path", source_path + "c")
+        if (os.path.exists(compiled_path)
+                and os.path.getmtime(compiled_path) >= os.path.getmtime(source_path)):
+            try:
+                return yara.load(compiled_path)
+            except yara.Error as e:
+                self.log.warning("Ignoring unreadable compiled rules %s: %s", compiled_path, e)
+        rules = yara.compile(source_path)
+        try:
+            rules.save(compiled_path)
+        except yara.Error as e:
+            self.log.warning("Could not save compiled rules to %s: %s", compiled_path, e)
+        return rules
+
+    def build_prefilter(self):
+        """Compile the YARA string patterns into an optional Hyperscan database."""
+        if hyperscan is None or not self.yara_rules or not self.config.get("hyperscan_prefilter", False):
+            return None
+        try:
+            with open(self.config.get("yara_rules_path", "rules.yara"), 'r') as f:
+                source = f.read()
+            patterns = self._prefilter_patterns(source)
+            if not patterns:
+                self.log.warning("YARA rules not expressible as a prefilter, scanning without it")
+                return None
+            db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+            expressions, flags = zip(*patterns)
+            db.compile(
+                expressions=list(expressions),
+                ids=list(range(len(patterns))),
+                elements=len(patterns),
+                flags=list(flags)
+            )
+            return db
+        except Exception as e:
+            self.log.warning("Failed to build Hyperscan prefilter: %s", e)
+            return None
+
+    def _prefilter_patterns(self, source: str) -> List[tuple]:
+        # The prefilter is only sound if every rule needs at least one string
+        # hit, so give up on rules whose condition could hold without one, or
+        # with strings we can't translate (hex strings, wide/xor/base64)
+        if not self._rules_need_string_hits(source):
+            return []
+        base_flags = hyperscan.HS_FLAG_DOTALL | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_PREFILTER
+        definitions = list(_YARA_STRING_DEF_RE.finditer(source))
+        if len(definitions) != len(_YARA_ANY_STRING_DEF_RE.findall(_YARA_COMMENT_RE.sub(" ", source))):
+            # Some definition wasn't recognized (e.g. several on one line),
+            # and a rule matching only on it would be dropped
+            return []
+        patterns = []
+        for m in definitions:
+            modifiers = set(m.group("modifiers").split("//")[0].split())
+            if m.group("hex") or not modifiers <= _PREFILTER_MODIFIERS:
+                return []
+            flags = base_flags
+            if "nocase" in modifiers or "i" in (m.group("flags") or ""):
+                flags |= hyperscan.HS_FLAG_CASELESS
+            if m.group("text") is not None:
+                literal = codecs.decode(m.group("text"), "unicode_escape")
+                expression = re.escape(literal).encode("latin-1")
+            else:
+                expression = m.group("regex").encode("latin-1")
+            patterns.append((expression, flags))
+        return patterns
+
+    def _rules_need_string_hits(self, source: str) -> bool:
+        # Accept only conditions built from string terms joined by and/or, so
+        # "not $a", "filesize > N", "#a == 0", "$a at 0", module calls and
+        # references to other rules all disable the prefilter
+        headers = list(_YARA_RULE_RE.finditer(source))
+        if not headers:
+            return False
+        for i, header in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(source)
+            body = _YARA_COMMENT_RE.sub(" ", source[header.end():end])
+            condition = _YARA_CONDITION_RE.search(body)
+            if not _YARA_STRINGS_RE.search(body) or not condition:
+                return False
+            reduced = _YARA_STRING_TERM_RE.sub(" X ", condition.group("condition"))
+            tokens = re.findall(r'[()]|[^\s()]+', reduced)
+            if "X" not in tokens or not set(tokens) <= {"X", "and", "or", "(", ")"}:
+                return False
+        return True
+
+    def prefilter_hit(self, data) -> bool:
+        """Check whether any YARA string could match before running full rules."""
+        if self.prefilter is None:
+            return True
+        hits = []
+
+        def on_match(pattern_id, start, end, flags, context):
+            hits.append(pattern_id)
+            return True  # One hit is enough to dispatch to YARA
+
+        # Hyperscan scratch space is per-database, so scans are serialized
+        with self._prefilter_lock:
+            try:
+                self.prefilter.scan(data, match_event_handler=on_match)
+            except hyperscan.ScanTerminated:
+                pass
+        return bool(hits)
+
+    def _match_data(self, data) -> List[str]:
+        # Two-stage scan: cheap Hyperscan trigger, then YARA to confirm
+        if not self.prefilter_hit(data):
+            return []
+        return [m.rule for m in self.yara_rules.match(data=data, timeout=YARA_TIMEOUT, fast=True)]
+
+    def create_behavioral_baseline(self, package: str, version: str,
+                                   now_iso: Optional[str] = None) -> Dict:
         """Create a baseline for package behavior."""
         baseline = {
             "package": package,
@@ -50,56 +439,156 @@ class SupplyChainSentry:
             "network_calls": [],
             "file_access": [],
             "hash": self.get_package_hash(package, version),
-            "created_at": datetime.now().isoformat()
+            "created_at": now_iso or datetime.now().isoformat()
         }
-        self.baselines[f"{package}:{version}"] = baseline
-        logger.info(f"Baseline created for {package}:{version}")
+        with self._baselines_lock:
+            self.baselines[f"{package}:{version}"] = baseline
+        self.log.info("Baseline created for %s:%s", package, version)
         return baseline
 
+    def create_behavioral_baselines(self, deps: List[tuple]) -> List[Dict]:
+        """Create baselines for many packages sharing one creation timestamp."""
+        now_iso = datetime.now().isoformat()
+        self.prefetch_metadata(deps, hashes=True, maintainers=False)
+        with ThreadPoolExecutor(max_workers=self.config.get("concurrency", 16)) as executor:
+            futures = [
+                executor.submit(self.create_behavioral_baseline, p, v, now_iso)
+                for p, v in deps
+            ]
+            return [future.result() for future in futures]
+
     def get_package_hash(self, package: str, version: str) -> str:
         """Calculate hash of package content."""
         try:
-            url = f"{self.config['registry_url']}/{package}/{version}/json"
-            response = requests.get(url)
-            if response.status_code == 200:
-                content = response.content
-                return hashlib.sha256(content).hexdigest()
+            url = self.release_url(package, version)
+            cached = self.cached_hash(url)
+            if cached is not None:
+                return cached
+            # Stream into the hasher so the body is never buffered whole
+            headers = self.conditional_headers(url, "hash")
+            with self.http.get(url, timeout=HTTP_TIMEOUT, stream=True, headers=headers) as response:
+                if response.status_code == 304:
+                    return self.refresh_cached(url, "hash")
+                if response.status_code == 200:
+                    hasher = self.new_hasher()
+                    for chunk in response.iter_content(HASH_CHUNK_SIZE):
+                        hasher.update(chunk)
+                    return self.store_hash(url, hasher.hexdigest(), response.headers)
             return ""
         except Exception as e:
-            logger.error(f"Error fetching package {package}:{version}: {e}")
+            self.log.error("Error fetching package %s:%s: %s", package, version, e)
             return ""
 
-    def analyze_package(self, package: str, version: str) -> Dict:
-        """Analyze package for potential risks."""
-        risk_score = 0.0
-        findings = []
+    def release_url(self, package: str, version: str) -> str:
+        """Registry metadata URL for a single release."""
+        return f"{self.config['registry_url']}/{package}/{version}/json"
 
-        # Static analysis with YARA
-        static_results = self.static_analysis(package, version)
-        if static_results.get("matches"):
-            risk_score += 0.4
-            findings.append("Potential backdoors detected in static analysis")
+    def project_url(self, package: str) -> str:
+        """Registry metadata URL for a project."""
+        return f"{self.config['registry_url']}/{package}/json"
 
-        # Dynamic analysis in container
-        dynamic_results = self.dynamic_analysis(package, version)
-        if dynamic_results.get("anomalies"):
-            risk_score += 0.3
-            findings.append("Anomalous behavior detected in dynamic analysis")
+    def cached_hash(self, url: str) -> Optional[str]:
+        """Return the cached hash for a release, if still fresh."""
+        # Release metadata changes too (files, yanked status, vulnerabilities),
+        # so expire it after a TTL and revalidate
+        cached = self._cached_entry(url, "hash")
+        ttl = self.config.get("release_cache_ttl", 86400)
+        if cached and time.time() - cached.get("fetched_at", 0) < ttl:
+            return cached["hash"]
+        return None
 
-        # Maintainer and contribution analysis
-        maintainer_score = self.analyze_maintainer(package)
-        risk_score += maintainer_score
-        if maintainer_score > 0.2:
-            findings.append("Suspicious maintainer activity")
+    def _cached_entry(self, url: str, field: str) -> Optional[Dict]:
+        # A cached entry usable for `field`; hashes must match the algorithm
+        cached = self.cache_get(url)
+        if not cached or field not in cached:
+            return None
+        if field == "hash" and cached.get("algorithm", "sha256") != self.hash_algorithm:
+            return None
+        return cached
+
+    def store_hash(self, url: str, digest: str, headers) -> str:
+        """Cache the hash of a release metadata response."""
+        self.cache_set(url, {
+            "hash": digest,
+            "algorithm": self.hash_algorithm,
+            "fetched_at": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")
+        })
+        return digest
+
+    def analyze_package(self, package: str, version: str,
+                        dynamic_results: Optional[Dict] = None,
+                        signals: Optional[Dict[str, float]] = None) -> Dict:
+        """Analyze package for potential risks."""
+        stages = self.stage_order()
+        signals = self.run_stages(package, version, stages, signals, dynamic_results)
+        # run_stages only leaves a stage out when fast_fail stopped it early
+        skipped = [stage for stage in stages if stage not in signals]
 
+        risk_score, findings = self.score_signals(signals)
         return {
             "package": package,
             "version": version,
             "risk_score": min(risk_score, 1.0),
-            "is_safe": risk_score < self.risk_threshold,
+            # A package that failed fast is unsafe even if a negative
+            # fast_fail_margin stopped it below the threshold
+            "is_safe": risk_score < self.risk_threshold and not skipped,
             "findings": findings
         }
 
+    def run_stages(self, package: str, version: str, stages: List[str],
+                   signals: Optional[Dict[str, float]] = None,
+                   dynamic_results: Optional[Dict] = None) -> Dict[str, float]:
+        """Run the given stages in order, skipping ones already done."""
+        signals = dict(signals or {})
+        for stage in stages:
+            # Stop early once the package is already over the threshold
+            if self.failed_fast(signals):
+                break
+            if stage not in signals:
+                signals[stage] = self.run_stage(stage, package, version, dynamic_results)
+        return signals
+
+    def failed_fast(self, signals: Dict[str, float]) -> bool:
+        """Whether fast_fail is on and the signals so far already exceed the threshold."""
+        if not self.config.get("fast_fail", False):
+            return False
+        margin = self.config.get("fast_fail_margin", 0.0)
+        return self.score_signals(signals)[0] >= self.risk_threshold + margin
+
+    def stage_order(self) -> List[str]:
+        """Analysis stages in the order they should run, cheapest first."""
+        order = [stage for stage in self.config.get("stage_order", ["maintainer", "static", "dynamic"])
+                 if stage in RISK_SIGNALS]
+        return order + [stage for stage in RISK_SIGNALS if stage not in order]
+
+    def run_stage(self, stage: str, package: str, version: str,
+                  dynamic_results: Optional[Dict] = None) -> float:
+        """Run one analysis stage and return its risk signal."""
+        if stage == "static":
+            # Static analysis with YARA
+            static_results = self.static_analysis(package, version)
+            return float(bool(static_results.get("matches")))
+        if stage == "dynamic":
+            # Dynamic analysis in container, unless a batched run already did it
+            if dynamic_results is None:
+                dynamic_results = self.dynamic_analysis(package, version)
+            return float(bool(dynamic_results.get("anomalies")))
+        # Maintainer and contribution analysis
+        return self.analyze_maintainer(package)
+
+    def score_signals(self, signals: Dict[str, float]) -> tuple:
+        """Weight risk signals into a score and the findings they trigger."""
+        risk_score = 0.0
+        findings = []
+        for name, (weight, threshold, finding) in RISK_SIGNALS.items():
+            value = signals.get(name, 0.0)
+            risk_score += weight * value
+            if value > threshold:
+                findings.append(finding)
+        return risk_score, findings
+
     def static_analysis(self, package: str, version: str) -> Dict:
         """Perform static analysis using YARA rules."""
         if not self.yara_rules:
@@ -108,57 +597,278 @@ class SupplyChainSentry:
         try:
             # Download package source (simplified for example)
             package_path = self.download_package(package, version)
-            matches = self.yara_rules.match(package_path)
-            return {"matches": [m.rule for m in matches], "error": None}
+            max_scan_bytes = self.config.get("max_scan_bytes", 32 * 1024 * 1024)
+            size = os.path.getsize(package_path)
+            if size > max_scan_bytes:
+                self.log.warning("Skipping static analysis for oversized %s:%s", package, version)
+                return {"matches": [], "error": None, "skipped": "oversize"}
+
+            with open(package_path, 'rb') as f:
+                magic = f.read(len(GZIP_MAGIC))
+            if magic == GZIP_MAGIC:
+                result = self._scan_tarball(package_path, max_scan_bytes)
+                if result["timeouts"] or result["skipped_members"] or result["truncated"]:
+                    self.log.warning(
+                        "Static analysis of %s:%s incomplete: %s timed out, %s skipped, truncated=%s",
+                        package, version, len(result["timeouts"]),
+                        len(result["skipped_members"]), result["truncated"]
+                    )
+                return result
+            elif self.prefilter is not None and size > 0:
+                # Map the file once so the prefilter and YARA share the same pages
+                with open(package_path, 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    rules = self._match_data(mm)
+            else:
+                # libyara maps the file itself when given a path
+                matches = self.yara_rules.match(package_path, timeout=YARA_TIMEOUT, fast=True)
+                rules = [m.rule for m in matches]
+            return {"matches": rules, "error": None}
         except Exception as e:
-            logger.error(f"Static analysis failed for {package}:{version}: {e}")
+            self.log.error("Static analysis failed for %s:%s: %s", package, version, e)
             return {"matches": [], "error": str(e)}
 
+    def _scan_tarball(self, package_path: str, max_scan_bytes: int) -> Dict:
+        # Compressed bytes can't match text signatures, so scan the .py members.
+        # max_scan_bytes also bounds the decompressed bytes read, per member
+        # and in total, so a small archive can't expand without limit.
+        result = {"matches": [], "error": None, "timeouts": [],
+                  "skipped_members": [], "truncated": False}
+        scanned = 0
+        with tarfile.open(package_path, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith(".py"):
+                    continue
+                if member.size > max_scan_bytes:
+                    result["skipped_members"].append(member.name)
+                    continue
+                if scanned + member.size > max_scan_bytes:
+                    result["truncated"] = True
+                    break
+                scanned += member.size
+                data = tar.extractfile(member).read(member.size)
+                try:
+                    rules = self._match_data(data)
+                except yara.TimeoutError:
+                    # Keep what already matched and report the member instead
+                    result["timeouts"].append(member.name)
+                    continue
+                for rule in rules:
+                    if rule not in result["matches"]:
+                        result["matches"].append(rule)
+        return result
+
     def dynamic_analysis(self, package: str, version: str) -> Dict:
         """Run package in a containerized environment and monitor behavior."""
+        if self.sandbox is None:
+            return {"anomalies": [], "error": "Sandbox container not running"}
+
         try:
-            container = self.docker_client.containers.run(
-                "python:3.9-slim",
-                f"pip install {package}=={version} && python -c 'import {package}'",
-                detach=True,
-                remove=True
+            timed_out, _, logs = self.run_in_sandbox(
+                shlex.quote(f"{package}=={version}"), f"import {package}"
             )
-            logs = container.logs().decode('utf-8')
             anomalies = self.detect_anomalies(logs, package, version)
+            if timed_out:
+                anomalies.append("Sandbox run timed out")
             return {"anomalies": anomalies, "logs": logs}
         except Exception as e:
-            logger.error(f"Dynamic analysis failed for {package}:{version}: {e}")
+            self.log.error("Dynamic analysis failed for %s:%s: %s", package, version, e)
             return {"anomalies": [], "error": str(e)}
 
+    def run_in_sandbox(self, install_args: str, script: str) -> tuple:
+        """Install packages into a fresh venv in the sandbox and run a script there.
+
+        Returns (timed_out, exit_code, output).
+        """
+        command = SANDBOX_COMMAND.format(
+            cache=SANDBOX_PIP_CACHE, install_args=install_args, script=shlex.quote(script)
+        )
+        timeout = self.config.get("sandbox_timeout", 300)
+        # The sandbox is shared, so bound how many installs run in it at once
+        with self._sandbox_slots:
+            exit_code, output = self.sandbox.exec_run(
+                ["timeout", "-k", "5", str(timeout), "sh", "-c", command]
+            )
+        return exit_code in SANDBOX_TIMEOUT_CODES, exit_code, output.decode('utf-8', 'replace')
+
+    def dynamic_analysis_batch(self, deps: List[tuple]) -> Dict[tuple, Dict]:
+        """Install and import a batch of packages with a single sandbox exec."""
+        if self.sandbox is None:
+            return {}
+
+        try:
+            specs = " ".join(shlex.quote(f"{p}=={v}") for p, v in deps)
+            marker = f"{SANDBOX_IMPORT_MARKER}-{secrets.token_hex(8)}"
+            script = SANDBOX_IMPORT_SCRIPT.format(
+                packages=[p for p, _ in deps], marker=marker
+            )
+            # Resolve dependencies like the per-package path does, so each
+            # package's import-time code actually runs
+            _, exit_code, output = self.run_in_sandbox(specs, script)
+        except Exception as e:
+            self.log.error("Batched dynamic analysis failed: %s", e)
+            return {}
+        if exit_code != 0:
+            # A failed or timed-out batch can't be attributed to one package,
+            # so leave the batch to per-package analysis
+            self.log.warning("Batched install failed for %s packages, analyzing individually", len(deps))
+            return {}
+
+        # Split the output into pip's install section and per-package import
+        # sections. Anything that doesn't look exactly like a marker for this
+        # batch is treated as ordinary output.
+        marker_re = re.compile(re.escape(marker) + r" (\d+)")
+        install_lines: List[str] = []
+        sections: Dict[int, List[str]] = {}
+        current = install_lines
+        for line in output.splitlines():
+            m = marker_re.fullmatch(line)
+            if m and int(m.group(1)) < len(deps):
+                current = sections.setdefault(int(m.group(1)), [])
+            else:
+                current.append(line)
+
+        # Install-time code (setup.py and friends) can't be attributed to one
+        # package, so every package in the batch is checked against it
+        install_logs = "\n".join(install_lines)
+        results = {}
+        for i, (package, version) in enumerate(deps):
+            logs = "\n".join([install_logs] + sections.get(i, []))
+            anomalies = self.detect_anomalies(logs, package, version)
+            results[(package, version)] = {"anomalies": anomalies, "logs": logs}
+        return results
+
     def detect_anomalies(self, logs: str, package: str, version: str) -> List[str]:
         """Detect anomalous behavior compared to baseline."""
-        baseline = self.baselines.get(f"{package}:{version}")
-        if not baseline:
-            return ["No baseline available"]
+        with self._baselines_lock:
+            baseline = self.baselines.get(f"{package}:{version}")
+            if not baseline:
+                return ["No baseline available"]
+            # Read the expected behavior now, since baselines may gain entries later
+            expects_network = bool(baseline["network_calls"])
+            expects_file_access = bool(baseline["file_access"])
 
-        anomalies = []
         # Simplified anomaly detection (expand with real patterns)
-        if "network error" in logs.lower() and not baseline["network_calls"]:
+        # One case-insensitive pass finds every trigger without copying the logs
+        seen = set()
+        for m in _ANOMALY_RE.finditer(logs):
+            seen.add(_ANOMALY_FIELDS[m.lastindex - 1])
+            if len(seen) == len(set(_ANOMALY_FIELDS)):
+                break
+
+        anomalies = []
+        if "network_calls" in seen and not expects_network:
             anomalies.append("Unexpected network activity")
-        if "permission denied" in logs.lower() and not baseline["file_access"]:
+        if "file_access" in seen and not expects_file_access:
             anomalies.append("Unexpected file access")
         return anomalies
 
     def analyze_maintainer(self, package: str) -> float:
         """Analyze package maintainer activity (simplified)."""
         try:
-            url = f"{self.config['registry_url']}/{package}/json"
-            response = requests.get(url)
+            url = self.project_url(package)
+            cached = self.cached_maintainer_score(url)
+            if cached is not None:
+                return cached
+            response = self.http.get(url, timeout=HTTP_TIMEOUT,
+                                     headers=self.conditional_headers(url, "maintainer_score"))
+            if response.status_code == 304:
+                return self.refresh_cached(url, "maintainer_score")
             if response.status_code == 200:
-                data = response.json()
-                maintainers = data.get("info", {}).get("maintainers", [])
-                # Simplified scoring: penalize new or few maintainers
-                return 0.1 if len(maintainers) < 2 else 0.05
+                return self.store_maintainer_score(url, response)
             return 0.2  # Default risk if no data
         except Exception as e:
-            logger.error(f"Maintainer analysis failed for {package}: {e}")
+            self.log.error("Maintainer analysis failed for %s: %s", package, e)
             return 0.2
 
+    def cached_maintainer_score(self, url: str) -> Optional[float]:
+        """Return the cached maintainer score for a project, if still fresh."""
+        # Project metadata changes with new releases, so expire it after a TTL
+        cached = self.cache_get(url)
+        ttl = self.config.get("maintainer_cache_ttl", 86400)
+        if cached and time.time() - cached["fetched_at"] < ttl:
+            return cached["maintainer_score"]
+        return None
+
+    def conditional_headers(self, url: str, field: str) -> Dict[str, str]:
+        """Validators from an expired cache entry holding `field`, for a conditional GET."""
+        cached = self._cached_entry(url, field)
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    def refresh_cached(self, url: str, field: str):
+        """Reuse a cached value after a 304 Not Modified, resetting its age."""
+        entry = dict(self.cache_get(url))
+        entry["fetched_at"] = time.time()
+        self.cache_set(url, entry)
+        return entry[field]
+
+    def store_maintainer_score(self, url: str, response) -> float:
+        """Score a project metadata response and cache the result."""
+        data = loads_json(response.content)
+        maintainers = data.get("info", {}).get("maintainers", [])
+        # Simplified scoring: penalize new or few maintainers
+        score = 0.1 if len(maintainers) < 2 else 0.05
+        self.cache_set(url, {
+            "maintainer_score": score,
+            "fetched_at": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        })
+        return score
+
+    def prefetch_metadata(self, deps: List[tuple], hashes: bool = False,
+                          maintainers: bool = True) -> None:
+        """Warm the registry cache for dependencies over one HTTP/2 connection.
+
+        Release hashes are only fetched when asked for, since only baselines use them.
+        """
+        if httpx is None or not self.config.get("http2_prefetch", True):
+            return
+        try:
+            asyncio.run(self._prefetch_async(deps, hashes, maintainers))
+        except Exception as e:
+            # Prefetching is best-effort; analysis falls back to the sync session
+            self.log.warning("Metadata prefetch failed: %s", e)
+
+    async def _prefetch_async(self, deps: List[tuple], hashes: bool, maintainers: bool) -> None:
+        limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=10) as client:
+            tasks = []
+            for package, version in deps if hashes else []:
+                url = self.release_url(package, version)
+                if self.cached_hash(url) is None:
+                    tasks.append(self._prefetch_hash(client, url))
+            for package in {package for package, _ in deps} if maintainers else set():
+                url = self.project_url(package)
+                if self.cached_maintainer_score(url) is None:
+                    tasks.append(self._prefetch_maintainer(client, url))
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _prefetch_hash(self, client, url: str) -> None:
+        async with client.stream("GET", url, headers=self.conditional_headers(url, "hash")) as response:
+            if response.status_code == 304:
+                self.refresh_cached(url, "hash")
+            elif response.status_code == 200:
+                hasher = self.new_hasher()
+                async for chunk in response.aiter_bytes(HASH_CHUNK_SIZE):
+                    hasher.update(chunk)
+                self.store_hash(url, hasher.hexdigest(), response.headers)
+
+    async def _prefetch_maintainer(self, client, url: str) -> None:
+        response = await client.get(url, headers=self.conditional_headers(url, "maintainer_score"))
+        if response.status_code == 304:
+            self.refresh_cached(url, "maintainer_score")
+        elif response.status_code == 200:
+            self.store_maintainer_score(url, response)
+
     def download_package(self, package: str, version: str) -> str:
         """Download package source (placeholder)."""
         # In a real implementation, download and extract package
@@ -169,36 +879,69 @@ class SupplyChainSentry:
         results = []
         try:
             with open(requirements_file, 'r') as f:
-                for line in f:
-                    if line.strip() and not line.startswith('#'):
-                        package, version = self.parse_requirement(line)
-                        if package:
-                            result = self.analyze_package(package, version)
-                            results.append(result)
+                deps = self.parse_requirements(f.read())
+
+            self.prefetch_metadata(deps)
+
+            # Packages are independent and I/O-bound, so analyze them concurrently
+            with ThreadPoolExecutor(max_workers=self.config.get("concurrency", 16)) as executor:
+                # With fast_fail, run the stages ordered before dynamic analysis
+                # first so packages that already fail never reach the sandbox
+                prechecked = {}
+                if self.config.get("fast_fail", False):
+                    order = self.stage_order()
+                    cheap = order[:order.index("dynamic")]
+                    futures = {dep: executor.submit(self.run_stages, dep[0], dep[1], cheap) for dep in deps}
+                    prechecked = {dep: future.result() for dep, future in futures.items()}
+                pending = [dep for dep in deps if not self.failed_fast(prechecked.get(dep, {}))]
+
+                # Batch installs so pip resolves many packages per invocation
+                dynamic = {}
+                batch_size = self.config.get("sandbox_batch_size", 20)
+                if batch_size > 1:
+                    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+                    for batch_results in executor.map(self.dynamic_analysis_batch, batches):
+                        dynamic.update(batch_results)
+
+                futures = [
+                    executor.submit(self.analyze_package, p, v, dynamic.get((p, v)), prechecked.get((p, v)))
+                    for p, v in deps
+                ]
+                results = [future.result() for future in futures]
         except Exception as e:
-            logger.error(f"Error monitoring project: {e}")
+            self.log.error("Error monitoring project: %s", e)
         return results
 
+    def parse_requirements(self, data: str) -> List[tuple]:
+        """Parse all pinned requirements from a requirements file's contents."""
+        deps = []
+        for m in _REQUIREMENT_RE.finditer(_CONTINUATION_RE.sub(" ", data)):
+            if m.group("other") is not None:
+                self.log.warning("Skipping unsupported requirement line: %s", m.group("other"))
+            elif m.group("name"):
+                deps.append((m.group("name"), m.group("version")))
+        return deps
+
     def parse_requirement(self, line: str) -> tuple:
         """Parse a single requirement line."""
-        try:
-            parts = line.strip().split('==')
-            if len(parts) == 2:
-                return parts[0].strip(), parts[1].strip()
-            return None, None
-        except:
-            return None, None
+        m = _REQUIREMENT_RE.match(_CONTINUATION_RE.sub(" ", line).strip())
+        if m and m.group("name"):
+            return m.group("name"), m.group("version")
+        return None, None
 
 def main():
     sentry = SupplyChainSentry()
     # Example: Monitor a requirements.txt file
-    results = sentry.monitor_project("requirements.txt")
+    try:
+        results = sentry.monitor_project("requirements.txt")
+    finally:
+        sentry.close()
     for result in results:
         status = "SAFE" if result["is_safe"] else "UNSAFE"
         logger.info(
-            f"Package: {result['package']}:{result['version']}, "
-            f"Risk Score: {result['risk_score']:.2f}, "
-            f"Status: {status}, Findings: {result['findings']}"
+            "Package: %s:%s, Risk Score: %.2f, Status: %s, Findings: %s",
+            result['package'], result['version'], result['risk_score'],
+            status, result['findings']
         )
 
 if __name__ == "__main__":